@@ -6,14 +6,27 @@ import os
 import nightlies
 from pathlib import Path
 import argparse
+import errno
 import shutil
 import time
 
 def copything(src, dst):
+    # Hardlink when possible: publishing a report then costs no data I/O.
+    # Hardlinks only work within one filesystem, so check the devices up
+    # front; real errors (like the destination already existing) propagate.
     if src.is_dir():
-        shutil.copytree(src, dst)
+        parent = dst.parent
+        while not parent.exists():
+            parent = parent.parent
+        same_fs = os.stat(src).st_dev == os.stat(parent).st_dev
+        shutil.copytree(src, dst, copy_function=os.link if same_fs else shutil.copy2)
     else:
-        shutil.copy2(src, dst)
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(src, dst)
 
 def info(runner : nightlies.NightlyRunner, args : argparse.Namespace) -> None:
     print(f"dir={runner.dir}")
@@ -32,11 +45,19 @@ def url(runner : nightlies.NightlyRunner, args : argparse.Namespace) -> None:
 def img(runner : nightlies.NightlyRunner, args : argparse.Namespace) -> None:
     runner.add_info("img", args.url)
 
+def current_repo(runner : nightlies.NightlyRunner) -> str:
+    # The runner tells the build which repo it is via the environment;
+    # fall back to the pid file for older runners
+    repo = os.getenv("NIGHTLY_REPO")
+    if repo:
+        return repo
+    assert "repo" in runner.data, "PID file does not have repo information"
+    return typing.cast(str, runner.data["repo"])
+
 def publish(runner : nightlies.NightlyRunner, args : argparse.Namespace) -> None:
     assert runner.report_dir.exists(), f"Report dir {runner.report_dir} does not exist"
     assert runner.base_url, f"Cannot publish, no baseurl configured"
-    assert "repo" in runner.data, "PID file does not have repo information"
-    repo = typing.cast(str, runner.data["repo"])
+    repo = current_repo(runner)
     name = args.name if args.name else str(int(time.time()))
 
     dest_dir : Path = runner.report_dir / repo / name
@@ -53,8 +74,7 @@ def publish(runner : nightlies.NightlyRunner, args : argparse.Namespace) -> None
     
 def download(runner : nightlies.NightlyRunner, args : argparse.Namespace) -> None:
     assert runner.report_dir.exists(), f"Report dir {runner.report_dir} does not exist"
-    assert "repo" in runner.data, "PID file does not have repo information"
-    repo = typing.cast(str, runner.data["repo"])
+    repo = current_repo(runner)
     src = runner.report_dir / repo / args.name
     dst = Path.cwd() / (args.to or args.name)
     runner.log(3, f"Copying {src} to {dst}")
@@ -72,7 +92,12 @@ def load():
     runner.load()
     runner.load_pid()
     os.chdir(old_cwd)
-    
+
+    # The runner points each branch's build at its own info file
+    info_file = os.getenv("NIGHTLY_INFO_FILE")
+    if info_file:
+        runner.info_file = Path(info_file)
+
     return runner
     
 def valid_url(s : str) -> str:
@@ -6,41 +6,45 @@ from datetime import datetime, timedelta
 from pathlib import Path
 import configparser
 import json
+import pickle
 import concurrent.futures, threading
+import functools
 import tempfile
 import shlex, shutil
+import fcntl
+import re
 import slack, apt
-import urllib.request
+import urllib.request, urllib.error
 
+@functools.lru_cache(maxsize=256)
 def format_time(ts : float) -> str:
     t = float(ts)
-    if t < 120:
-        return f"{t:.1f}s"
-    elif t < 120*60:
-        return f"{t/60:.1f}m"
-    else:
-        return f"{t/60/60:.1f}h"
-    
-def format_cmd(s : Sequence[Union[str, Path]]) -> str:
-    if hasattr(shlex, "join"):
-        return shlex.join([str(part) for part in s])
-    else: # Compatibility with old Python 3
-        return " ".join([
-            str(part) if " " not in str(part) else '"{}"'.format(part)
-            for part in s
-        ])
+    return f"{t:.1f}s" if t < 120 else f"{t/60:.1f}m" if t < 7200 else f"{t/3600:.1f}h"
+
+
+# Arguments made only of these characters need no shell quoting
+SAFE_ARG = re.compile(r"[\w@%+=:,./-]+\Z", re.ASCII).match
 
+def format_cmd(s : Sequence[Union[str, Path]]) -> str:
+    # Almost every argument is a plain word or path; skip shlex.quote for those
+    return " ".join([
+        part if SAFE_ARG(part) else shlex.quote(part)
+        for part in map(str, s)
+    ])
+
+TIME_RE = re.compile(r"^\s*([0-9.]+)\s*(hr|h|min|m|sec|s)?\s*$")
+TIME_UNITS = {
+    "hr": 3600, "h": 3600,
+    "min": 60, "m": 60,
+    "sec": 1, "s": 1,
+}
+
+@functools.lru_cache(maxsize=256)
 def parse_time(to : Optional[str]) -> Optional[float]:
     if to is None: return to
-    units = {
-        "hr": 3600, "h": 3600,
-        "min": 60, "m": 60,
-        "sec": 1, "s": 1,
-    }
-    for unit, multiplier in units.items():
-        if to.endswith(unit):
-            return float(to[:-len(unit)]) * multiplier
-    return float(to)
+    match = TIME_RE.match(to)
+    if not match: return float(to)
+    return float(match[1]) * TIME_UNITS.get(match[2] or "s", 1)
 
 def repo_to_url(repo : str) -> str:
     if repo and ":" in repo: return repo
@@ -48,7 +52,7 @@ def repo_to_url(repo : str) -> str:
 
 SYSTEMD_SLICE = "nightlies.slice"
 
-SYSTEMD_RUN_CMD = [
+SYSTEMD_RUN_CMD = (
     "sudo", # There might not be a user session manager, so run using root's
     "systemd-run",
     "--collect", # If it fails, throw it away
@@ -59,7 +63,14 @@ SYSTEMD_RUN_CMD = [
     f"--gid={os.getgid()}", # As the current group
     f"--slice={SYSTEMD_SLICE}", # Run with the nightly resource limits
     "--service-type=simple", # It just execs a program
-]
+)
+
+# Maps a GitHub pulls URL to (etag, parsed result) so repeat queries
+# can send If-None-Match and skip downloading an unchanged response
+PR_BRANCH_CACHE : Dict[str, Any] = {}
+
+# Escapes branch names into safe file names in a single string pass
+FILENAME_TRANS = str.maketrans({"%": "%25", "/": "%2f"})
 
 REPO_BADGES = [
     "baseline", # Run this branch if you run anything else
@@ -72,23 +83,31 @@ class NightlyRunner:
         self.config_file = Path(config_file)
         self.self_dir = Path(__file__).resolve().parent
         self.data : Any = None
+        self.start_clock : Optional[int] = None
+        self.log_fd : Optional[int] = None
+        self.log_fd_path : Optional[Path] = None
         self.log_lock = threading.Lock()
+        # Re-entrant: save() is often called with the lock already held
+        self.data_lock = threading.RLock()
+        self.apt_lock = threading.Lock()
+        self.dirty = False
+        self.last_save = 0.0
 
     def update_system_repo(self, dir : str, repo : str, branch : str) -> None:
         if not Path(dir).is_dir():
             self.log(1, f"Downloading system {repo} repository {dir}")
             self.exec(2, ["git", "-C", dir, "clone", "--recursive",
-                          "--branch", branch, "--", repo_to_url(repo), dir])
+                          "--branch", branch, "--", repo_to_url(repo), dir], capture=False)
             self.restart()
 
         self.log(1, f"Updating system {repo} repository in {dir}")
         try:
-            conf_commit = self.exec(2, ["git", "-C", dir, "rev-parse", "HEAD"]).stdout
-            self.log(2, f"Commit {conf_commit.decode().strip()}")
-            self.exec(2, ["git", "-C", dir, "fetch", "origin", "--prune"])
-            self.exec(2, ["git", "-C", dir, "reset", "--hard", "origin/" + branch])
-            conf_commit2 = self.exec(2, ["git", "-C", dir, "rev-parse", "HEAD"]).stdout
-            self.log(2, f"Commit {conf_commit2.decode().strip()}")
+            conf_commit = self.exec(2, ["git", "-C", dir, "rev-parse", "HEAD"], text=True).stdout
+            self.log(2, f"Commit {conf_commit.strip()}")
+            self.exec(2, ["git", "-C", dir, "fetch", "origin", "--prune"], capture=False)
+            self.exec(2, ["git", "-C", dir, "reset", "--hard", "origin/" + branch], capture=False)
+            conf_commit2 = self.exec(2, ["git", "-C", dir, "rev-parse", "HEAD"], text=True).stdout
+            self.log(2, f"Commit {conf_commit2.strip()}")
         except subprocess.CalledProcessError as e:
             self.log(0, f"Process {format_cmd(e.cmd)} returned error code {e.returncode}")
             sys.exit(1)
@@ -114,13 +133,40 @@ class NightlyRunner:
         self.info_file = Path(defaults.get("info", "running.info")).resolve()
         self.config_file = Path(defaults.get("conffile", str(self.config_file))).resolve()
         self.report_dir = Path(defaults.get("reports", "reports")).resolve()
+        self.parallel = self.config.getint("DEFAULT", "parallel", fallback=1)
+        # Opt-in: delete logs older than this, e.g. keeplogs = 720hr
+        self.keep_logs = parse_time(defaults.get("keeplogs"))
 
         self.secrets = configparser.ConfigParser()
         if defaults.get("secrets"):
-            for file in Path(defaults["secrets"]).iterdir():
-                if not file.name.endswith(".conf"): continue
-                with file.open() as f:
-                    self.secrets.read_file(f, source=f.name)
+            secrets_dir = Path(defaults["secrets"])
+            cache_file = secrets_dir / ".secrets.cache.pkl"
+            files = sorted([
+                file for file in secrets_dir.iterdir()
+                if file.name.endswith(".conf")
+            ])
+            # restart() re-execs whenever a system repo updates, so avoid
+            # re-parsing every secrets file unless one actually changed
+            key = [(file.name, file.stat().st_mtime_ns) for file in files]
+            try:
+                with cache_file.open("rb") as f:
+                    cached_key, cached = pickle.load(f)
+            except (OSError, pickle.PickleError, EOFError):
+                cached_key, cached = None, None
+            if cached_key == key:
+                self.secrets = cached
+            else:
+                for file in files:
+                    with file.open() as f:
+                        self.secrets.read_file(f, source=f.name)
+                try:
+                    fd = os.open(str(cache_file), os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+                    with os.fdopen(fd, "wb") as f:
+                        pickle.dump((key, self.secrets), f)
+                except OSError:
+                    # Read-only checkout, or the cache belongs to the other of
+                    # the runner/server users; the parse above still stands
+                    pass
 
         for name in self.config.sections():
             self.repos.append(Repository(self, name, self.config[name]))
@@ -145,36 +191,72 @@ class NightlyRunner:
         self.log(0, "Restarting nightly run due to updated system repositories")
         os.execv(sys.executable, ["python3"] + sys.argv)
 
-    def exec(self, level : int, cmd : List[Union[str, Path]]) -> subprocess.CompletedProcess:
+    def exec(self, level : int, cmd : List[Union[str, Path]], text : bool = False, capture : bool = True) -> subprocess.CompletedProcess:
         self.log(level, f"Executing {format_cmd(cmd)}")
-        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+        # No caller reads the output of most git plumbing, so skip the pipe
+        stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+        return subprocess.run(cmd, stdout=stdout, stderr=subprocess.STDOUT, check=True, text=text)
 
     def log(self, level : int, s : str) -> None:
-        self.log_lock.acquire()
-        with self.log_path.open("at") as f:
-            f.write("{}\t{}{}\n".format(datetime.now() - self.start, "    " * level, s))
-        self.log_lock.release()
+        if self.start_clock is not None:
+            # Monotonic, so log timestamps can't go backwards if the wall clock shifts
+            elapsed = timedelta(microseconds=(time.monotonic_ns() - self.start_clock) // 1000)
+        else:
+            # Attached to someone else's run (via load_pid); only wall time is known
+            elapsed = datetime.now() - self.start
+        line = "{}\t{}{}\n".format(elapsed, "    " * level, s)
+        with self.log_lock:
+            # Keep the fd across calls; O_APPEND makes each line one atomic write
+            if self.log_fd is None or self.log_fd_path != self.log_path:
+                if self.log_fd is not None:
+                    os.close(self.log_fd)
+                self.log_fd = os.open(str(self.log_path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                self.log_fd_path = self.log_path
+            os.write(self.log_fd, line.encode("utf8"))
 
     def save(self) -> None:
-        with self.pid_file.open("w") as f:
-            json.dump(self.data, f)
+        # Saves happen on every state change, so coalesce them to at most
+        # one write per second; flush() runs at important sync points.
+        self.dirty = True
+        now = time.monotonic()
+        if now - self.last_save > 1.0:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.dirty: return
+        # Write to a temporary file and rename so readers never see partial JSON
+        fd, tmp = tempfile.mkstemp(dir=str(self.pid_file.parent), prefix=self.pid_file.name)
+        try:
+            with os.fdopen(fd, "w") as f:
+                # Hold the lock so parallel branch workers can't mutate
+                # self.data mid-dump
+                with self.data_lock:
+                    json.dump(self.data, f, separators=(",", ":"))
+            os.replace(tmp, str(self.pid_file))
+        except OSError:
+            os.unlink(tmp)
+            raise
+        self.dirty = False
+        self.last_save = time.monotonic()
 
     def add_info(self, cmd : str, *args : str) -> None:
-        data = format_cmd([cmd] + list(args))
-        self.log(3, f"Adding info {data}")
+        self.log(3, f"Adding info {format_cmd([cmd] + list(args))}")
+        # Tab-separated, so reading it back is a plain split, not shlex
         with self.info_file.open("a") as f:
-            f.write(data + "\n")
+            f.write("\t".join([cmd] + list(args)) + "\n")
 
-    def load_info(self) -> Dict[str, str]:
+    def load_info(self, info_file : Optional[Path] = None) -> Dict[str, str]:
+        if info_file is None:
+            info_file = self.info_file
         out = {}
         try:
-            with self.info_file.open("r") as f:
+            with info_file.open("r") as f:
                 for line in f:
                     if not line.strip(): continue
-                    cmd, *args = shlex.split(line)
+                    cmd, *args = line.rstrip("\n").split("\t")
                     out[cmd] = " ".join(args)
             # Clear the info file file
-            self.info_file.open("w").close()
+            info_file.open("w").close()
         except OSError as e:
             self.log(2, f"Error loading info file: {e}")
         return out
@@ -189,10 +271,13 @@ class NightlyRunner:
             return
 
     def try_lock(self) -> bool:
+        # The lock fd stays open for the life of the process; the kernel
+        # releases the lock automatically when we exit, even on a crash.
+        self.lock_fd = os.open(str(self.pid_file.with_suffix(".lock")), os.O_CREAT | os.O_RDWR)
         try:
-            self.pid_file.touch(exist_ok=False)
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
             return True
-        except FileExistsError:
+        except OSError:
             return False
 
     def lock(self) -> bool:
@@ -207,18 +292,17 @@ class NightlyRunner:
                 self.log(0, f"Nightly already running")
 
             if self.config.getboolean("DEFAULT", "wait", fallback=True):
-                while True:
-                    if self.try_lock():
-                        return True
-                    else:
-                        self.log(1, f"Sleeping for 15 minutes...")
-                        time.sleep(15 * 60)
+                self.log(1, f"Waiting for the current nightly run to finish...")
+                # Block in the kernel; wakes up the moment the lock is released
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+                return True
             else:
                 return False
 
 
     def run(self) -> None:
         self.start = datetime.now()
+        self.start_clock = time.monotonic_ns()
         name = f"{self.start:%Y-%m-%d}-{self.start:%H%M%S}.log"
         self.log_path = self.log_dir / name
         self.log(0, f"Nightly script starting up at {self.start:%H:%M}")
@@ -235,60 +319,107 @@ class NightlyRunner:
             "log": str(self.log_path),
         }
         self.save()
+        self.flush()
 
         if self.dryrun:
             self.log(0, "Running in dry-run mode. No nightlies will be executed.")
 
         if Path(".git/info").exists():
-            with open(".git/info/exclude", "wt") as f:
-                for repo in self.repos:
-                    f.write(repo.dir.name + "\n")
+            exclude = Path(".git/info/exclude")
+            expected = "".join(repo.dir.name + "\n" for repo in self.repos)
+            try:
+                current = exclude.read_text()
+            except OSError:
+                current = ""
+            if current != expected:
+                exclude.write_text(expected)
 
-        plan = []
-        for repo in self.repos:
+        def load_repo(repo : Repository) -> None:
             try:
-                self.data["repo"] = repo.name
-                self.save()
                 repo.load()
                 repo.plan()
-                plan.extend(repo.runnable)
             except subprocess.CalledProcessError as e:
                 repo.fatalerror = f"Process {format_cmd(e.cmd)} returned error code {e.returncode}"
                 self.log(1, repo.fatalerror)
                 repo.post()
-            finally:
-                del self.data["repo"]
 
-        for i, branch in enumerate(plan):
-            if i and not self.dryrun:
-                self.log(1, f"Waiting for machine to cool down")
-                time.sleep(30) # To avoid thermal throttling
+        if self.parallel > 1:
+            # The load phase is dominated by git fetch, so overlap the repos
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                list(pool.map(load_repo, self.repos))
+        else:
+            for repo in self.repos:
+                try:
+                    self.data["repo"] = repo.name
+                    self.save()
+                    load_repo(repo)
+                finally:
+                    del self.data["repo"]
 
-            try:
-                self.data["repo"] = branch.repo.name
-                self.data["branch"] = branch.name
-                self.data["runs_done"] = i
-                self.data["runs_total"] = len(plan)
-                self.save()
+        plan = []
+        for repo in self.repos:
+            plan.extend(repo.runnable)
 
+        remaining = { branch.repo.name: 0 for branch in plan }
+        for branch in plan:
+            remaining[branch.repo.name] += 1
+        self.data["runs_done"] = 0
+        self.data["runs_total"] = len(plan)
+        self.save()
+
+        def run_branch(branch : Branch) -> None:
+            try:
                 branch.run()
             except subprocess.CalledProcessError as e:
-                repo.fatalerror = f"Process {format_cmd(e.cmd)} returned error code {e.returncode}"
-                self.log(1, repo.fatalerror)
+                branch.repo.fatalerror = f"Process {format_cmd(e.cmd)} returned error code {e.returncode}"
+                self.log(1, branch.repo.fatalerror)
             finally:
-                if all([idx <= i for idx, b in enumerate(plan) if branch.repo == b.repo]):
+                with self.data_lock:
+                    self.data["runs_done"] += 1
+                    remaining[branch.repo.name] -= 1
+                    done = not remaining[branch.repo.name]
+                    self.save()
+                if done:
                     self.log(0, f"Finished nightly run for {branch.repo.name}")
                     branch.repo.post()
 
-                del self.data["repo"]
-                del self.data["branch"]
-                # del self.data["runs_done"]
-                # del self.data["runs_total"]
-                self.save()
+        if self.parallel > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as pool:
+                list(pool.map(run_branch, plan))
+        else:
+            for i, branch in enumerate(plan):
+                if i and not self.dryrun:
+                    self.log(1, f"Waiting for machine to cool down")
+                    time.sleep(30) # To avoid thermal throttling
 
+                self.data["repo"] = branch.repo.name
+                self.data["branch"] = branch.name
+                self.save()
+                try:
+                    run_branch(branch)
+                finally:
+                    del self.data["repo"]
+                    del self.data["branch"]
+                    self.save()
+                    self.flush()
+
+        self.flush()
+        if self.keep_logs is not None:
+            self.prune_logs()
         self.pid_file.unlink()
         self.log(0, "Finished nightly run for today")
 
+    def prune_logs(self) -> None:
+        self.log(1, f"Pruning logs older than {format_time(self.keep_logs)}")
+        cutoff = time.time() - cast(float, self.keep_logs)
+        with os.scandir(self.log_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".log"): continue
+                if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    self.log(2, f"Deleting old log {entry.name}")
+                    if not self.dryrun:
+                        os.unlink(entry.path)
+
 class Repository:
     def __init__(self, runner : NightlyRunner, name : str, configuration : configparser.SectionProxy):
         self.runner = runner
@@ -313,25 +444,70 @@ class Repository:
             for path in shlex.split(self.config.get("ignore", ""))
         } | set([self.checkout, self.status])
         self.fatalerror: Optional[str] = None
-
-    def list_branches(self) -> List[str]:
-        git_branch = self.runner.exec(2, ["git", "-C", self.checkout, "branch", "-r"])
-        return [
-            branch.split("/", 1)[-1] for branch
-            in git_branch.stdout.decode("utf8").strip().split("\n")
-            if "->" not in branch
-        ]
+        self.worktree_lock = threading.Lock()
+        self.last_commits : Optional[Dict[str, bytes]] = None
+
+        # Snapshot the remaining configuration keys up front; SectionProxy
+        # lookups walk the defaults chain and interpolate on every call
+        self.apt_pkgs = configuration.get("apt", "").split()
+        self.branch_names : Optional[List[str]] = \
+            configuration["branches"].split() if "branches" in configuration else None
+        self.do_clean = configuration.getboolean("clean", fallback=True)
+        self.badge_branches = {
+            field: set(configuration.get(field, "").split()) for field in REPO_BADGES
+        }
+        self.main_branch = configuration.get("main", "main")
+        self.timeout = parse_time(configuration.get("timeout"))
+        self.fetch_jobs = configuration.getint("fetch_jobs", fallback=4)
+        # Opt-in: tip-only history; breaks builds that need git describe or log
+        self.shallow = configuration.getboolean("shallow", fallback=False)
+
+    def probe_remote_heads(self) -> Dict[str, bytes]:
+        """Ask the remote for its branch tips without downloading anything."""
+        git_refs = self.runner.exec(2, ["git", "-C", self.checkout,
+                                        "ls-remote", "--heads", "origin"], text=True)
+        heads = {}
+        for line in git_refs.stdout.split("\n"):
+            commit, _, ref = line.partition("\t")
+            if not ref.startswith("refs/heads/"): continue
+            heads[ref[len("refs/heads/"):]] = commit.encode("ascii") + b"\n"
+        return heads
+
+    def list_remote_heads(self) -> Dict[str, bytes]:
+        """Map each remote branch to its commit hash with one git invocation."""
+        git_refs = self.runner.exec(2, ["git", "-C", self.checkout, "for-each-ref",
+                                        "--format=%(refname:lstrip=3) %(objectname)", "refs/remotes/origin"], text=True)
+        heads = {}
+        for line in git_refs.stdout.split("\n"):
+            branch, _, commit = line.partition(" ")
+            if not branch or branch == "HEAD": continue
+            # Trailing newline matches rev-parse output, which .last-commit files store
+            heads[branch] = commit.encode("ascii") + b"\n"
+        return heads
 
     def list_pr_branches(self) -> Dict[str, int]:
         if self.url.startswith("git@github.com:") and self.url.endswith(".git"):
             gh_name = self.url[len("git@github.com:"):-len(".git")]
-            pulls_url = f"https://api.github.com/repos/{gh_name}/pulls"
-            with urllib.request.urlopen(pulls_url) as data:
-                pr_data = json.load(data)
+            pulls_url = f"https://api.github.com/repos/{gh_name}/pulls?per_page=100"
+            etag, cached = PR_BRANCH_CACHE.get(pulls_url, (None, None))
+            req = urllib.request.Request(pulls_url)
+            req.add_header("Accept", "application/vnd.github+json")
+            if etag:
+                req.add_header("If-None-Match", etag)
+            try:
+                with urllib.request.urlopen(req) as data:
+                    pr_data = json.load(data)
+                    etag = data.headers.get("ETag")
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and cached is not None:
+                    return cast(Dict[str, int], cached)
+                raise
             out = {}
             for pr in pr_data:
                 if pr["head"]["repo"]["full_name"] == gh_name:
                     out[pr["head"]["ref"]] = pr["number"]
+            if etag:
+                PR_BRANCH_CACHE[pulls_url] = (etag, out)
             return out
         else:
             return {}
@@ -340,73 +516,112 @@ class Repository:
         self.runner.log(0, "Beginning nightly run for " + self.name)
         self.dir.mkdir(parents=True, exist_ok=True)
 
-        apt_pkgs = self.config.get("apt", "").split()
+        apt_pkgs = self.apt_pkgs
         if apt_pkgs:
-            updates = apt.check_updates(self.runner, apt_pkgs)
-            if updates:
-                if not self.runner.dryrun:
-                    apt.install(self.runner, apt_pkgs)
-                self.run_all = True
+            with self.runner.apt_lock: # dpkg can't run concurrently
+                updates = apt.check_updates(self.runner, apt_pkgs)
+                if updates:
+                    if not self.runner.dryrun:
+                        apt.install(self.runner, apt_pkgs)
+                    self.run_all = True
 
         if not self.checkout.is_dir():
             self.runner.log(1, "Checking out base repository for " + self.name)
-            self.runner.exec(2, ["git", "clone", "--recursive", self.url, self.checkout])
-            self.runner.exec(2, ["git", "-C", self.checkout, "checkout", "--detach"])
+            clone_cmd : List[Union[str, Path]] = ["git", "clone", "--recursive"]
+            if self.shallow:
+                # --depth implies --single-branch, but we need every branch tip
+                clone_cmd += ["--depth=1", "--no-single-branch", "--no-tags", "--shallow-submodules"]
+            self.runner.exec(2, clone_cmd + [self.url, self.checkout], capture=False)
+            self.runner.exec(2, ["git", "-C", self.checkout, "checkout", "--detach"], capture=False)
 
         self.runner.log(1, "Updating branches for " + self.name)
-        self.runner.exec(2, ["git", "-C", self.checkout, "fetch", "origin", "--prune", "--recurse-submodules"])
-
-        if "branches" in self.config:
-            all_branches = self.config["branches"].split()
+        heads = self.list_remote_heads()
+        if self.probe_remote_heads() != heads:
+            fetch_cmd : List[Union[str, Path]] = \
+                ["git", "-C", self.checkout, "fetch", "origin", "--prune", "--recurse-submodules"]
+            if self.shallow:
+                # Builds that need git describe or tags opted out of history
+                fetch_cmd += ["--depth=1", "--no-tags"]
+            self.runner.exec(2, fetch_cmd, capture=False)
+            heads = self.list_remote_heads()
         else:
-            all_branches = self.list_branches()
+            # ls-remote answers from the ref advertisement alone, so an idle
+            # repo skips the fetch's object negotiation and ref updates
+            self.runner.log(2, "Remote branches unchanged, skipping fetch")
+        all_branches = self.branch_names if self.branch_names is not None else list(heads)
         self.branches = { branch: Branch(self, branch) for branch in all_branches }
-
-        if self.config.getboolean("clean", fallback=True):
+        for name, branch in self.branches.items():
+            branch.current_commit = heads.get(name)
+
+        # One directory scan replaces a stat+open+read per branch in plan()
+        self.last_commits = {}
+        with os.scandir(self.dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".last-commit"): continue
+                name = Branch.parse_filename(entry.name[:-len(".last-commit")])
+                with open(entry.path, "rb") as f:
+                    self.last_commits[name] = f.read()
+
+        if self.do_clean:
             self.clean()
 
-        for branch in self.branches.values():
-            branch.load()
-
         self.assign_badges()
 
+        # Idle branches skip the worktree/reset dance entirely; plan() only
+        # needs the shared checkout's refs to decide
+        branches = [
+            branch for branch in self.branches.values()
+            if self.run_all or "always" in branch.badges
+            or "baseline" in branch.badges or branch.plan()
+        ]
+        if self.fetch_jobs > 1 and len(branches) > 1:
+            # Branch loads are independent resets of separate worktrees, so
+            # overlap them; the first-time worktree setup serializes on a lock
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_jobs) as pool:
+                list(pool.map(lambda branch: branch.load(), branches))
+        else:
+            for branch in branches:
+                branch.load()
+
     def clean(self) -> None:
         expected_files = self.ignored_files.union(*[
             {b.dir, b.lastcommit} for b in self.branches.values()
         ])
+        # Only direct children can match, so compare names and let scandir's
+        # cached stat answer is_dir without a second syscall per entry
+        expected_names = { fn.name for fn in expected_files if fn.parent == self.dir }
         self.runner.log(1, "Cleaning unnecessary files")
-        deleted = False
-        for fn in self.dir.iterdir():
-            if fn not in expected_files:
-                self.runner.log(2, f"Deleting unknown file {fn}")
-                if not self.runner.dryrun:
-                    if fn.is_dir():
-                        shutil.rmtree(str(fn))
-                    else:
-                        fn.unlink()
-                    deleted = True
-        self.runner.exec(2, ["git", "-C", self.checkout, "worktree", "prune"])
+        with os.scandir(self.dir) as entries:
+            for entry in entries:
+                if entry.name not in expected_names:
+                    self.runner.log(2, f"Deleting unknown file {entry.path}")
+                    if not self.runner.dryrun:
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(entry.path)
+                        else:
+                            os.unlink(entry.path)
+        self.runner.exec(2, ["git", "-C", self.checkout, "worktree", "prune"], capture=False)
 
     def read(self) -> None:
         self.branches = {}
         if self.dir.is_dir():
-            for fn in self.dir.iterdir():
-                if not fn.is_dir(): continue
-                if fn in self.ignored_files: continue
-                name = Branch.parse_filename(fn.name)
-                self.branches[name] = Branch(self, name)
+            ignored_names = { fn.name for fn in self.ignored_files if fn.parent == self.dir }
+            with os.scandir(self.dir) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False): continue
+                    if entry.name in ignored_names: continue
+                    name = Branch.parse_filename(entry.name)
+                    self.branches[name] = Branch(self, name)
             self.assign_badges()
 
     def assign_badges(self) -> None:
-        for field in REPO_BADGES:
-            for branch_name in self.config.get(field, "").split():
-                if branch_name in self.branches:
-                    branch = self.branches[branch_name]
+        for name, branch in self.branches.items():
+            for field in REPO_BADGES:
+                if name in self.badge_branches[field]:
                     branch.badges.append(field)
 
-        main_branch = self.config.get("main", "main")
-        if main_branch in self.branches:
-            self.branches[main_branch].badges.append("main")
+        if self.main_branch in self.branches:
+            self.branches[self.main_branch].badges.append("main")
 
     def plan(self) -> None:
         if self.run_all:
@@ -415,18 +630,22 @@ class Repository:
 
         self.runner.log(1, "Filtering branches " + ", ".join(self.branches))
         self.runnable = [branch for name, branch in self.branches.items() if branch.plan()]
+        runnable_set = set(self.runnable)
         for branch in self.branches.values():
-            if "always" in branch.badges and branch not in self.runnable:
+            if "always" in branch.badges and branch not in runnable_set:
                 self.runner.log(2, f"Adding always run on branch {branch.name}")
                 self.runnable.append(branch)
+                runnable_set.add(branch)
             if "baseline" in branch.badges and self.runnable:
                 self.runner.log(2, f"Adding baseline branch {branch.name}")
-                if branch in self.runnable:
+                if branch in runnable_set:
                     self.runnable.remove(branch)
+                runnable_set.add(branch)
                 self.runnable.insert(0, branch)
-            if "never" in branch.badges and branch in self.runnable:
+            if "never" in branch.badges and branch in runnable_set:
                 self.runner.log(2, f"Removing never run on branch {branch.name}")
                 self.runnable.remove(branch)
+                runnable_set.discard(branch)
         if self.runnable:
             self.runner.log(1, "Found runnable branches " + ", ".join([b.name for b in self.runnable]))
         else:
@@ -464,6 +683,8 @@ class Branch:
         self.lastcommit = self.repo.dir / (self.filename + ".last-commit")
         self.badges : List[str] = []
         self.info : Dict[str, str] = {}
+        self.current_commit : Optional[bytes] = None
+        self.will_run : Optional[bool] = None
 
     def last_run(self) -> float:
         try:
@@ -477,54 +698,112 @@ class Branch:
 
     @staticmethod
     def escape_filename(filename : str) -> str:
-        return filename.replace("%", "%25").replace("/", "%2f")
+        return filename.translate(FILENAME_TRANS)
 
     def load(self) -> None:
-        if not self.dir.is_dir():
-            relpath = self.dir.relative_to(self.repo.dir)
-            self.repo.runner.exec(2, ["git", "-C", self.repo.checkout, "worktree", "add", ".." / relpath, self.name])
-            self.repo.runner.exec(2, ["git", "-C", self.dir, "submodule", "update", "--init"])
-        self.repo.runner.exec(2, ["git", "-C", self.dir, "reset", "--hard", "--recurse-submodules", "origin/" + self.name])
+        with self.repo.worktree_lock: # git worktree add mutates shared .git metadata
+            if not self.dir.is_dir():
+                relpath = self.dir.relative_to(self.repo.dir)
+                self.repo.runner.exec(2, ["git", "-C", self.repo.checkout, "worktree", "add", ".." / relpath, self.name], capture=False)
+                if (self.dir / ".gitmodules").exists():
+                    self.repo.runner.exec(2, ["git", "-C", self.dir, "submodule", "update", "--init",
+                                              f"--jobs={os.cpu_count()}"], capture=False)
+        if (self.dir / ".gitmodules").exists():
+            self.repo.runner.exec(2, ["git", "-C", self.dir, "reset", "--hard", "--recurse-submodules", "origin/" + self.name], capture=False)
+        else:
+            self.repo.runner.exec(2, ["git", "-C", self.dir, "reset", "--hard", "origin/" + self.name], capture=False)
 
     def plan(self) -> bool:
-        current_commit = self.repo.runner.exec(2, ["git", "-C", self.dir, "rev-parse", "origin/" + self.name]).stdout
-        if self.lastcommit.is_file():
-            with self.lastcommit.open("rb") as f:
-                last_commit = f.read()
-            if last_commit == current_commit:
+        if self.will_run is None:
+            if self.current_commit is None:
+                # Not preloaded by list_remote_heads; ask the shared checkout,
+                # which has every origin ref even before the worktree exists
+                self.current_commit = self.repo.runner.exec(
+                    2, ["git", "-C", self.repo.checkout, "rev-parse", "origin/" + self.name]).stdout
+            self.will_run = True
+            if self.repo.last_commits is not None:
+                last_commit = self.repo.last_commits.get(self.name)
+            elif self.lastcommit.is_file():
+                # The repo was read() rather than load()ed, so hit the disk
+                with self.lastcommit.open("rb") as f:
+                    last_commit = f.read()
+            else:
+                last_commit = None
+            if last_commit == self.current_commit:
                 self.repo.runner.log(2, "Branch " + self.name + " has not changed since last run; skipping")
-                return False
-        return True
+                self.will_run = False
+        return self.will_run
 
     def run(self) -> None:
         self.repo.runner.log(0, f"Running branch {self.name} on repo {self.repo.name}")
         date = datetime.now()
         log_name = f"{date:%Y-%m-%d}-{date:%H%M%S}-{self.repo.name}-{self.filename}.log"
 
-        self.repo.runner.data["branch_log"] = log_name
-        self.repo.runner.save()
-
-        t = datetime.now()
+        # Branches overlap when parallel > 1, so each gets its own slot in
+        # the pid file rather than fighting over one shared key
+        key = f"{self.repo.name}/{self.name}"
+        with self.repo.runner.data_lock:
+            branches = cast(Dict[str, Any], self.repo.runner.data.setdefault("branches", {}))
+            branches[key] = {"log": log_name}
+            self.repo.runner.save()
+
+        # Each branch gets its own info file, so concurrent builds can't
+        # misattribute each other's url/img/emoji records
+        base = self.repo.runner.info_file
+        info_file = base.with_name(f"{base.stem}-{self.repo.name}-{self.filename}{base.suffix}")
+
+        # A predictable unit name, so the timeout path can stop exactly this
+        # build; systemd unit names only allow a limited character set
+        unit = re.sub(r"[^A-Za-z0-9_.-]", "-",
+                      f"nightly-{self.repo.name}-{self.filename}-{date:%H%M%S}")
+
+        t = time.monotonic()
         try:
-            to = parse_time(self.repo.config.get("timeout"))
+            to = self.repo.timeout
             env_path = str(self.repo.runner.self_dir) + ":" + cast(str, os.getenv('PATH'))
-            cmd = SYSTEMD_RUN_CMD + \
-                ["--setenv=NIGHTLY_CONF_FILE=" + str(self.repo.runner.config_file.resolve())] + \
-                [f"--setenv=PATH={env_path}", "make", "-C", str(self.dir), "nightly"]
+            cmd = (*SYSTEMD_RUN_CMD,
+                   f"--unit={unit}",
+                   "--setenv=NIGHTLY_CONF_FILE=" + str(self.repo.runner.config_file.resolve()),
+                   "--setenv=NIGHTLY_REPO=" + self.repo.name,
+                   "--setenv=NIGHTLY_BRANCH=" + self.name,
+                   "--setenv=NIGHTLY_INFO_FILE=" + str(info_file),
+                   f"--setenv=PATH={env_path}", "make", "-C", str(self.dir), "nightly")
             self.repo.runner.log(1, f"Executing {format_cmd(cmd)}")
             if not self.repo.runner.dryrun:
-                with (self.repo.runner.log_dir / log_name).open("wt") as fd:
+                info_file.unlink(missing_ok=True) # Stale records from a crashed run
+                # Hand the raw fd to the child; only it ever writes the log
+                fd = os.open(str(self.repo.runner.log_dir / log_name),
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
                     process = subprocess.Popen(cmd, stdout=fd, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
-                    self.repo.runner.data["branch_pid"] = process.pid
-                    self.repo.runner.save()
+                    with self.repo.runner.data_lock:
+                        branches[key]["pid"] = process.pid
+                        self.repo.runner.save()
+                    self.repo.runner.flush() # So /killbranch can find the pid right away
                     try:
                         process.wait(timeout=to)
                         p = process.poll()
                         if p: raise subprocess.CalledProcessError(p, cmd)
                     finally:
-                        self.info = self.repo.runner.load_info()
-                        process.kill()
-                        self.repo.runner.exec(2, ["sudo", "systemctl", "stop", "nightlies.slice"])
+                        self.info = self.repo.runner.load_info(info_file)
+                        # The build is a transient unit under PID 1, not a
+                        # child of ours, so signalling the systemd-run client
+                        # can't reach make; stop the unit itself, which kills
+                        # the whole cgroup including any daemons left behind
+                        try:
+                            self.repo.runner.exec(2, ["sudo", "systemctl", "stop", unit + ".service"], capture=False)
+                        except subprocess.CalledProcessError:
+                            pass # The unit already exited and was collected
+                        try:
+                            # Reap the --wait client, which exits with the unit
+                            process.wait(timeout=60)
+                        except subprocess.TimeoutExpired:
+                            try:
+                                process.kill()
+                            except PermissionError:
+                                pass # The client runs under sudo; root will reap it
+                finally:
+                    os.close(fd)
         except subprocess.TimeoutExpired as e:
             self.repo.runner.log(1, f"Run on branch {self.name} timed out after {format_time(e.timeout)}")
             failure = "timeout"
@@ -536,15 +815,24 @@ class Branch:
             failure = ""
 
         if not self.repo.runner.dryrun:
-            out = self.repo.runner.exec(2, ["git", "-C", self.dir, "rev-parse", f"origin/{self.name}"])
-            with self.lastcommit.open("wb") as last_commit_fd:
-                last_commit_fd.write(out.stdout)
+            if self.current_commit is None:
+                # Not every path through plan() resolves the branch, e.g. run_all
+                self.current_commit = self.repo.runner.exec(
+                    2, ["git", "-C", self.dir, "rev-parse", f"origin/{self.name}"]).stdout
+            # Write-and-rename so a crash can't leave a truncated commit hash
+            tmp = self.lastcommit.with_suffix(".tmp")
+            with tmp.open("wb") as last_commit_fd:
+                last_commit_fd.write(self.current_commit)
+            os.replace(tmp, self.lastcommit)
+            if self.repo.last_commits is not None:
+                self.repo.last_commits[self.name] = self.current_commit
 
         self.info["result"] = f"*{failure}*" if failure else "success"
-        self.info["time"] = format_time((datetime.now() - t).seconds)
+        self.info["time"] = format_time(time.monotonic() - t)
         self.info["file"] = log_name
-        del self.repo.runner.data["branch_log"]
-        self.repo.runner.save()
+        with self.repo.runner.data_lock:
+            branches.pop(key, None)
+            self.repo.runner.save()
 
 if __name__ == "__main__":
     import sys
@@ -48,12 +48,16 @@ def load():
             running = True
 
     last_print = None
-    if runner.data and "branch_log" in runner.data:
-        log_file = runner.log_dir / runner.data["branch_log"]
-        try:
-            last_print = time.time() - os.path.getmtime(str(log_file))
-        except FileNotFoundError:
-            running = False
+    if runner.data and runner.data.get("branches"):
+        ages = []
+        for state in runner.data["branches"].values():
+            log_file = runner.log_dir / state["log"]
+            try:
+                ages.append(time.time() - os.path.getmtime(str(log_file)))
+            except FileNotFoundError:
+                running = False
+        if ages:
+            last_print = min(ages)
 
     logins = set([
         line.split()[0].decode("utf8", errors="replace")
@@ -156,7 +160,7 @@ def kill():
     runner = nightlies.NightlyRunner(CONF_FILE)
     runner.load()
     runner.load_pid()
-    if runner.data and "branch_pid" in runner.data:
+    if runner.data and "pid" in runner.data:
         try:
             os.kill(runner.data["pid"], signal.SIGTERM)
             runner.pid_file.unlink()
@@ -168,16 +172,19 @@ def kill():
 
 @bottle.post("/killbranch")
 def killbranch():
+    key = bottle.request.forms.get('key')
     runner = nightlies.NightlyRunner(CONF_FILE)
     runner.load()
     runner.load_pid()
-    if runner.data and "branch_pid" in runner.data:
+    branches = runner.data.get("branches", {}) if runner.data else {}
+    state = branches.get(key) if key else next(iter(branches.values()), None)
+    if state and "pid" in state:
         try:
-            os.kill(runner.data["branch_pid"], signal.SIGTERM)
+            os.kill(state["pid"], signal.SIGTERM)
         except OSError as e:
             print("/killbranch: OSError:", str(e))
     else:
-        print("/killbranch: no PID file")
+        print("/killbranch: no running branch")
 
     bottle.redirect("/")
     
@@ -1,7 +1,9 @@
 from typing import Dict, Any, List, Union
 import os
 import json
-import urllib.request, urllib.error
+import http.client
+import threading
+import urllib.parse
 
 class Block:
     def to_json(self) -> Dict[str, Any]:
@@ -99,6 +101,9 @@ class Button(Accessory):
             accessory["style"] = self.style
         return accessory
 
+# Info keys rendered specially in build_runs, not shown as plain fields
+SPECIAL_FIELDS = frozenset(["url", "emoji", "result", "time", "img", "file"])
+
 def build_runs(name : str, runs : Dict[str, Dict[str, str]], baseurl : str) -> Response:
     res = Response(f"Nightly data for {name}")
     for branch, info in runs.items():
@@ -122,7 +127,7 @@ def build_runs(name : str, runs : Dict[str, Dict[str, str]], baseurl : str) -> R
 
         fields = {
             k: v for k, v in info.items()
-            if k not in ["url", "emoji", "result", "time", "img", "file"]
+            if k not in SPECIAL_FIELDS
         }
         if fields:
             res.add(Fields(fields))
@@ -139,15 +144,33 @@ def build_fatal(name : str, text : str, baseurl : str) -> Response:
     res.add(TextBlock(text))
     return res
 
+# Keep-alive connections per host, so posting for N repos does one TLS handshake
+CONNECTIONS : Dict[str, http.client.HTTPSConnection] = {}
+CONNECTIONS_LOCK = threading.Lock()
+
 def send(runner, url: str, res: Response) -> None:
-    payload = json.dumps(res.to_json()).encode("utf8")
-    req = urllib.request.Request(url, data=payload, method="POST")
-    req.add_header("Content-Type", "application/json; charset=utf8")
-
-    try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            runner.log(2, f"Slack returned response {response.status} {response.reason}, because {response.read()}")
-    except urllib.error.HTTPError as exc:
-        reason = exc.read().decode('utf-8')
-        runner.log(2, f"Slack error: {exc.code} {exc.reason}, because {reason}")
+    payload = json.dumps(res.to_json(), separators=(",", ":")).encode("utf8")
+    headers = {"Content-Type": "application/json; charset=utf8"}
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+
+    with CONNECTIONS_LOCK:
+        conn = CONNECTIONS.get(parts.netloc)
+        if conn is None:
+            conn = CONNECTIONS[parts.netloc] = http.client.HTTPSConnection(parts.netloc, timeout=10)
+        try:
+            conn.request("POST", path, payload, headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The server may have closed an idle keep-alive connection; retry once
+            conn.close()
+            conn = CONNECTIONS[parts.netloc] = http.client.HTTPSConnection(parts.netloc, timeout=10)
+            conn.request("POST", path, payload, headers)
+            response = conn.getresponse()
+        body = response.read().decode("utf-8", errors="replace")
+
+    if response.status >= 400:
+        runner.log(2, f"Slack error: {response.status} {response.reason}, because {body}")
         runner.log(2, repr(payload))
+    else:
+        runner.log(2, f"Slack returned response {response.status} {response.reason}, because {body}")